@@ -3,46 +3,322 @@
 
 
 import argparse
+import collections
+import concurrent.futures
+import functools
+import io
+import mmap
 import pathlib
+import sys
 
 
-from Bio.SeqIO.FastaIO import SimpleFastaParser
+from fasta_io import FastaWriter, format_fasta_record, is_compressed, open_input, read_fasta
+
+
+# Upper bound on bytes read by a worker at once when filtering in parallel
+CHUNK_SIZE_MAX = 64 * 1024 * 1024
+
+
+# Fields of a samtools compatible FASTA index (.fai)
+FaiEntry = collections.namedtuple('FaiEntry', ('name', 'length', 'offset', 'line_bases', 'line_width'))
+
+
+class WordMatcher:
+    '''Aho-Corasick automaton to match many words against a description in a single pass'''
+
+    def __init__(self, words, case_sensitive=False, whole_word=False):
+        self.case_sensitive = case_sensitive
+        self.whole_word = whole_word
+        # Each state has a transition dict, a failure link, and lengths of words ending at it
+        self.transitions = [dict()]
+        self.fail = [0]
+        self.outputs = [tuple()]
+        for word in words:
+            self._add_word(word if case_sensitive else word.lower())
+        self._build_fail_links()
+
+    def _add_word(self, word):
+        state = 0
+        for char in word:
+            try:
+                state = self.transitions[state][char]
+            except KeyError:
+                self.transitions[state][char] = len(self.transitions)
+                state = len(self.transitions)
+                self.transitions.append(dict())
+                self.fail.append(0)
+                self.outputs.append(tuple())
+        if len(word) not in self.outputs[state]:
+            self.outputs[state] += (len(word), )
+
+    def _build_fail_links(self):
+        # Breadth first so that failure states are always resolved before their children
+        queue = collections.deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                fail = self.fail[state]
+                while fail and char not in self.transitions[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.transitions[fail].get(char, 0)
+                self.outputs[next_state] += self.outputs[self.fail[next_state]]
+
+    def matches(self, desc):
+        if not self.case_sensitive:
+            desc = desc.lower()
+        transitions = self.transitions
+        fail = self.fail
+        outputs = self.outputs
+        state = 0
+        for i, char in enumerate(desc):
+            while state and char not in transitions[state]:
+                state = fail[state]
+            state = transitions[state].get(char, 0)
+            if not outputs[state]:
+                continue
+            if not self.whole_word:
+                return True
+            for length in outputs[state]:
+                if is_word_bounded(desc, i - length + 1, i + 1):
+                    return True
+        return False
 
 
 def get_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_fp', required=True, type=pathlib.Path,
-            help='Input FASTA file')
-    parser.add_argument('--contains', required=True, nargs='+',
+            help='Input FASTA file, optionally gzip or BGZF compressed')
+    contains = parser.add_mutually_exclusive_group(required=True)
+    contains.add_argument('--contains', nargs='+',
             help='Description contains')
+    contains.add_argument('--contains_file', type=pathlib.Path,
+            help='File containing words to match, one per line')
+    contains.add_argument('--ids', nargs='+',
+            help='Extract records by ID using a .fai index (built if missing)')
+    contains.add_argument('--ids_file', type=pathlib.Path,
+            help='File containing IDs to extract, one per line')
+    contains.add_argument('--build_index', action='store_true',
+            help='Write a samtools compatible .fai index for the input and exit')
     parser.add_argument('--case_sensitive', action='store_true',
             help='Perform case insensitive matching')
+    parser.add_argument('--whole_word', action='store_true',
+            help='Only match words bounded by non-alphanumeric characters')
+    parser.add_argument('--threads', type=int, default=1,
+            help='Number of processes to filter descriptions with [default: 1]')
+    parser.add_argument('--decompress_threads', type=int, default=1,
+            help='Number of threads to decompress BGZF input with [default: 1]')
 
     args = parser.parse_args()
     if not args.input_fp.exists():
         parser.error('Input file %s does not exist' % args.input_fp)
+    if args.contains_file and not args.contains_file.exists():
+        parser.error('Input file %s does not exist' % args.contains_file)
+    if args.ids_file and not args.ids_file.exists():
+        parser.error('Input file %s does not exist' % args.ids_file)
+    if args.threads < 1:
+        parser.error('--threads must be at least 1')
+    if args.decompress_threads < 1:
+        parser.error('--decompress_threads must be at least 1')
+    args.input_compressed = is_compressed(args.input_fp)
+    if args.input_compressed and (args.ids or args.ids_file or args.build_index):
+        parser.error('Indexed extraction requires an uncompressed input file')
+    if args.input_compressed and args.threads > 1:
+        print('WARNING: compressed input cannot be split, filtering with one process', file=sys.stderr)
+        args.threads = 1
+    if not args.input_fp.is_file() and args.threads > 1:
+        print('WARNING: streamed input cannot be split, filtering with one process', file=sys.stderr)
+        args.threads = 1
+    args.index_fp = args.input_fp.with_name(args.input_fp.name + '.fai')
     return args
 
 
 def main():
     args = get_arguments()
 
-    # Set case sensitivity once outside of main loop
-    if args.case_sensitive:
+    # Indexed modes, build the index if it is missing or older than the FASTA
+    index_stale = (not args.index_fp.exists() or
+            args.index_fp.stat().st_mtime < args.input_fp.stat().st_mtime)
+    if args.build_index or ((args.ids or args.ids_file) and index_stale):
+        write_fasta_index(build_fasta_index(args.input_fp), args.index_fp)
+    if args.build_index:
+        return
+    if args.ids or args.ids_file:
+        extract_by_ids(args)
+        return
+
+    # Collect words
+    if args.contains_file:
+        with args.contains_file.open('r') as fh:
+            words = [line.strip() for line in fh if line.strip()]
+    else:
         words = args.contains
-        fasta_contains_word = lambda desc, words: any(w in desc for w in words)
+
+    # Use the automaton for large word lists and whole word matching, otherwise simple search
+    # Set case sensitivity once outside of main loop
+    if args.contains_file or args.whole_word:
+        fasta_contains_word = WordMatcher(words, args.case_sensitive, args.whole_word).matches
     else:
-        words = [w.lower() for w in args.contains]
-        fasta_contains_word = lambda desc, words: any(w in desc.lower() for w in words)
+        if not args.case_sensitive:
+            words = [w.lower() for w in words]
+        fasta_contains_word = functools.partial(contains_any, words=words, case_sensitive=args.case_sensitive)
+
+    # Filter byte ranges in parallel, output is collected in input order with chunks in flight limited
+    # to bound memory
+    if args.threads > 1:
+        chunk_bounds = get_chunk_bounds(args.input_fp, args.threads)
+        # Matcher is sent once to each worker rather than with every chunk
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=args.threads,
+                initializer=initialise_worker, initargs=(fasta_contains_word, ))
+        with executor:
+            jobs = collections.deque()
+            for start, end in chunk_bounds:
+                jobs.append(executor.submit(filter_chunk, args.input_fp, start, end))
+                if len(jobs) >= args.threads * 2:
+                    sys.stdout.buffer.write(jobs.popleft().result())
+            while jobs:
+                sys.stdout.buffer.write(jobs.popleft().result())
+        return
 
     # Iterate records and print if criteria met
-    with args.input_fp.open('r') as fh:
-        for desc, seq in SimpleFastaParser(fh):
-            if not fasta_contains_word(desc, words):
+    with open_input(args.input_fp, args.decompress_threads) as fh, FastaWriter(sys.stdout.buffer) as writer:
+        for desc, seq in read_fasta(fh):
+            if not fasta_contains_word(desc.decode()):
                 continue
-            print('>', desc, sep='')
-            for line in [seq[i:i+80] for i in range(0, len(seq), 80)]:
-                print(line)
+            writer.write(desc, seq)
+
+
+def get_chunk_bounds(fasta_fp, threads):
+    # Split into several chunks per process to balance load, with each chunk starting on a record
+    file_size = fasta_fp.stat().st_size
+    if not file_size:
+        return list()
+    chunk_number = max(threads * 4, file_size // CHUNK_SIZE_MAX + 1)
+    chunk_size = file_size // chunk_number + 1
+    starts = [0]
+    with fasta_fp.open('rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as fasta_mm:
+        for position in range(chunk_size, file_size, chunk_size):
+            record_start = fasta_mm.find(b'\n>', max(position, starts[-1]) - 1)
+            if record_start == -1:
+                break
+            if record_start + 1 > starts[-1]:
+                starts.append(record_start + 1)
+    return list(zip(starts, starts[1:] + [file_size]))
+
+
+def initialise_worker(fasta_contains_word):
+    global worker_contains_word
+    worker_contains_word = fasta_contains_word
+
+
+def filter_chunk(fasta_fp, start, end):
+    with fasta_fp.open('rb') as fh:
+        fh.seek(start)
+        chunk = io.BytesIO(fh.read(end - start))
+    output = list()
+    for desc, seq in read_fasta(chunk):
+        if not worker_contains_word(desc.decode()):
+            continue
+        output.append(format_fasta_record(desc, seq))
+    return b''.join(output)
+
+
+def extract_by_ids(args):
+    # Collect IDs
+    if args.ids_file:
+        with args.ids_file.open('r') as fh:
+            ids = [line.strip() for line in fh if line.strip()]
+    else:
+        ids = args.ids
+
+    # Check for missing IDs before writing anything
+    index = read_fasta_index(args.index_fp)
+    ids_missing = [record_id for record_id in ids if record_id not in index]
+    if ids_missing:
+        print('Could not find: ', *ids_missing, sep='\n', file=sys.stderr)
+        sys.exit(1)
+
+    # Seek directly to each record
+    with args.input_fp.open('rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as fasta_mm:
+        with FastaWriter(sys.stdout.buffer) as writer:
+            for record_id in ids:
+                writer.write(*fetch_record(fasta_mm, index[record_id]))
+
+
+def build_fasta_index(fasta_fp):
+    entries = list()
+    with fasta_fp.open('rb') as fh:
+        offset = 0
+        name = None
+        for line in fh:
+            if line.startswith(b'>'):
+                # Records without sequence are indexed with zero length so they can still be fetched
+                if name is not None:
+                    entries.append(FaiEntry(name, length, seq_offset, line_bases, line_width))
+                name_tokens = line[1:].split(maxsplit=1)
+                name = name_tokens[0].decode() if name_tokens else str()
+                seq_offset = offset + len(line)
+                length = line_bases = line_width = 0
+                short_line_seen = False
+            elif name is not None:
+                # All lines except the last must have the same length for offsets to be computed
+                bases = len(line.rstrip(b'\r\n'))
+                if bases and short_line_seen:
+                    print('Record %s has lines of unequal length' % name, file=sys.stderr)
+                    sys.exit(1)
+                if not line_bases:
+                    line_bases, line_width = bases, len(line)
+                elif bases > line_bases or (bases == line_bases and len(line) != line_width):
+                    print('Record %s has lines of unequal length' % name, file=sys.stderr)
+                    sys.exit(1)
+                if bases < line_bases or not bases:
+                    short_line_seen = True
+                length += bases
+            offset += len(line)
+        if name is not None:
+            entries.append(FaiEntry(name, length, seq_offset, line_bases, line_width))
+    return entries
+
+
+def write_fasta_index(entries, index_fp):
+    with index_fp.open('w') as fh:
+        for entry in entries:
+            print(*entry, sep='\t', file=fh)
+
+
+def read_fasta_index(index_fp):
+    index = dict()
+    with index_fp.open('r') as fh:
+        line_token_gen = (line.rstrip('\n').split('\t') for line in fh)
+        for name, *fields in line_token_gen:
+            index[name] = FaiEntry(name, *(int(field) for field in fields[:4]))
+    return index
+
+
+def fetch_record(fasta_mm, entry):
+    # Description line directly precedes the sequence offset
+    desc_start = fasta_mm.rfind(b'\n', 0, entry.offset - 1) + 1
+    desc = fasta_mm[desc_start+1:entry.offset].rstrip()
+    if not entry.line_bases:
+        return desc, bytes()
+    full_lines, remainder = divmod(entry.length, entry.line_bases)
+    seq_end = entry.offset + full_lines * entry.line_width + remainder
+    seq = fasta_mm[entry.offset:seq_end].translate(None, b'\r\n')
+    return desc, seq
+
+
+def contains_any(desc, words, case_sensitive):
+    if not case_sensitive:
+        desc = desc.lower()
+    return any(w in desc for w in words)
+
+
+def is_word_bounded(desc, start, end):
+    if start > 0 and (desc[start-1].isalnum() or desc[start-1] == '_'):
+        return False
+    if end < len(desc) and (desc[end].isalnum() or desc[end] == '_'):
+        return False
+    return True
 
 
 if __name__ == '__main__':
@@ -1,23 +1,70 @@
 #!/usr/bin/env python3
 '''Extract gene nucleotide sequence in FASTA format from genbank records'''
 import argparse
+import collections
+import concurrent.futures
 import pathlib
+import re
+import sqlite3
+import sys
 
 
 import Bio.SeqIO
 
 
-FASTA_DESC_TEMPL = '>%s_%s %s'
+from fasta_io import FastaWriter
+
+
+FASTA_DESC_TEMPL = '%s_%s %s'
+
+# Qualifiers used to name genes, in order of preference
+NAME_QUALIFIERS = ('gene', 'locus_tag', 'note')
+
+INDEX_SCHEMA = '''
+CREATE TABLE files (id INTEGER PRIMARY KEY, path TEXT, size INTEGER, mtime REAL);
+CREATE TABLE records (id INTEGER PRIMARY KEY, file_id INTEGER, name TEXT, origin_start INTEGER, origin_end INTEGER);
+CREATE TABLE cds (id INTEGER PRIMARY KEY, record_id INTEGER, name TEXT, number INTEGER, locus_tag TEXT,
+        location TEXT, start INTEGER, end INTEGER, strand INTEGER);
+CREATE INDEX cds_name ON cds (name);
+CREATE INDEX cds_locus_tag ON cds (locus_tag);
+'''
+
+COMPLEMENT = bytes.maketrans(b'ACGTURYKMBVDHSWNacgturykmbvdhswn', b'TGCAAYRMKVBHDSWNtgcaayrmkvbhdswn')
 
 
 def get_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--input_fp', required=True, type=pathlib.Path,
-            help='Input genabnk filepath')
+    parser.add_argument('--input_fp', nargs='+', type=pathlib.Path,
+            help='Input genabnk filepaths as space separated list')
+    parser.add_argument('--fast', action='store_true',
+            help='Stream CDS locations and names without building full records with Biopython')
+    parser.add_argument('--threads', type=int, default=1,
+            help='Number of processes to parse input files with [default: 1]')
+    parser.add_argument('--build_index', type=pathlib.Path,
+            help='Write a SQLite CDS index of the input files to this filepath and exit')
+    parser.add_argument('--index', type=pathlib.Path,
+            help='Extract genes using a CDS index rather than parsing input files')
+    parser.add_argument('--names', nargs='+',
+            help='Gene names to extract from index')
+    parser.add_argument('--locus_tags', nargs='+',
+            help='Locus tags to extract from index')
+    parser.add_argument('--regex',
+            help='Regular expression matched against gene names in index')
 
     args = parser.parse_args()
-    if not args.input_fp.exists():
-        parser.error('Input file %s does not exist' % args.input_fp)
+    if args.index:
+        if not args.index.exists():
+            parser.error('Input file %s does not exist' % args.index)
+        if not (args.names or args.locus_tags or args.regex):
+            parser.error('--index requires --names, --locus_tags or --regex')
+        return args
+    if not args.input_fp:
+        parser.error('--input_fp is required unless querying with --index')
+    for input_fp in args.input_fp:
+        if not input_fp.exists():
+            parser.error('Input file %s does not exist' % input_fp)
+    if args.threads < 1:
+        parser.error('--threads must be at least 1')
     return args
 
 
@@ -25,34 +72,268 @@ def main():
     # Get command line arguments
     args = get_arguments()
 
-    # Iterate genbank records; giving unique name to each gene
+    # Index modes
+    if args.build_index:
+        build_index(args.input_fp, args.build_index)
+        return
+    if args.index:
+        with FastaWriter(sys.stdout.buffer) as writer:
+            cds_gen = query_index(args.index, args.names, args.locus_tags, args.regex)
+            for name, number, record_name, sequence in cds_gen:
+                writer.write(FASTA_DESC_TEMPL % (name, number, record_name), sequence)
+        return
+
+    # Iterate genbank records; giving unique name to each gene. Genes are numbered here rather
+    # than in workers so that numbering follows input order
+    seen_names = dict()
+    with FastaWriter(sys.stdout.buffer) as writer:
+        for name, record_name, sequence in iterate_files_cds(args.input_fp, args.fast, args.threads):
+            number = get_gene_number(seen_names, name, record_name)
+            fasta_desc = FASTA_DESC_TEMPL % (name, number, record_name)
+            writer.write(fasta_desc, sequence)
+
+
+def get_gene_number(seen_names, name, record_name):
+    try:
+        seen_names[(name, record_name)] += 1
+    except KeyError:
+        seen_names[(name, record_name)] = 1
+    return seen_names[(name, record_name)]
+
+
+def build_index(input_fps, index_fp):
+    if index_fp.exists():
+        index_fp.unlink()
     seen_names = dict()
-    with args.input_fp.open('r') as fh:
-        for genbank_record in Bio.SeqIO.parse(fh, 'genbank'):
-            for feature in genbank_record.features:
-                if feature.type != 'CDS':
-                    continue
-                name = str()
-                if 'gene' in feature.qualifiers:
-                    name = feature.qualifiers['gene'][0]
-                elif 'locus_tag' in feature.qualifiers:
-                    name = feature.qualifiers['locus_tag'][0]
-                elif 'note' in feature.qualifiers:
-                    name = feature.qualifiers['note'][0]
-
-                number = int()
-                try:
-                    seen_names[(name, genbank_record.name)] += 1
-                except KeyError:
-                    seen_names[(name, genbank_record.name)] = 1
-                finally:
-                    number = seen_names[(name, genbank_record.name)]
-
-                fasta_desc = FASTA_DESC_TEMPL % (name, number, genbank_record.name)
-                sequence = feature.extract(genbank_record).seq
-                print(fasta_desc)
-                for line in [sequence[i:i+80] for i in range(0, len(sequence), 80)]:
-                    print(line)
+    with sqlite3.connect(index_fp) as connection:
+        connection.executescript(INDEX_SCHEMA)
+        for input_fp in input_fps:
+            file_stat = input_fp.stat()
+            file_id = connection.execute('INSERT INTO files (path, size, mtime) VALUES (?, ?, ?)',
+                    (str(input_fp.resolve()), file_stat.st_size, file_stat.st_mtime)).lastrowid
+            with input_fp.open('rb') as fh:
+                for record_name, cds_lines_all, _, (origin_start, origin_end) in iterate_records_fast(fh):
+                    record_id = connection.execute('INSERT INTO records (file_id, name, origin_start, origin_end) '
+                            'VALUES (?, ?, ?, ?)', (file_id, record_name, origin_start, origin_end)).lastrowid
+                    cds_rows = list()
+                    for cds_lines in cds_lines_all:
+                        location, qualifiers = parse_feature_lines(cds_lines)
+                        name = get_cds_name(qualifiers)
+                        number = get_gene_number(seen_names, name, record_name)
+                        parts = parse_location(location)
+                        strands = {strand for start, end, strand in parts}
+                        cds_rows.append((record_id, name, number, qualifiers.get('locus_tag'), location,
+                                min(start for start, end, strand in parts), max(end for start, end, strand in parts),
+                                strands.pop() if len(strands) == 1 else 0))
+                    connection.executemany('INSERT INTO cds (record_id, name, number, locus_tag, location, start, end, '
+                            'strand) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', cds_rows)
+
+
+def query_index(index_fp, names, locus_tags, regex):
+    with sqlite3.connect(index_fp) as connection:
+        # Refuse to read from files that have changed since indexing
+        for path, size, mtime in connection.execute('SELECT path, size, mtime FROM files'):
+            file_stat = pathlib.Path(path).stat()
+            if file_stat.st_size != size or file_stat.st_mtime != mtime:
+                print('Index is out of date for %s, rebuild with --build_index' % path, file=sys.stderr)
+                sys.exit(1)
+
+        # Select any CDS matching criteria in the order they were indexed
+        conditions = list()
+        parameters = list()
+        if names:
+            conditions.append('cds.name IN (%s)' % ','.join('?' * len(names)))
+            parameters.extend(names)
+        if locus_tags:
+            conditions.append('cds.locus_tag IN (%s)' % ','.join('?' * len(locus_tags)))
+            parameters.extend(locus_tags)
+        if regex:
+            name_re = re.compile(regex)
+            connection.create_function('REGEXP', 2, lambda pattern, value: bool(name_re.search(value)))
+            conditions.append('cds.name REGEXP ?')
+            parameters.append(regex)
+        query = ('SELECT cds.name, cds.number, records.name, cds.location, records.id, records.origin_start, '
+                'records.origin_end, files.path FROM cds JOIN records ON cds.record_id = records.id '
+                'JOIN files ON records.file_id = files.id WHERE %s ORDER BY cds.id') % ' OR '.join(conditions)
+
+        # Read the ORIGIN block of each record directly, reusing it for consecutive genes
+        sequence_record_id = None
+        for row in connection.execute(query, parameters):
+            name, number, record_name, location, record_id, origin_start, origin_end, path = row
+            if record_id != sequence_record_id:
+                with open(path, 'rb') as fh:
+                    fh.seek(origin_start)
+                    sequence = clean_origin_sequence(fh.read(origin_end - origin_start))
+                sequence_record_id = record_id
+            yield name, number, record_name, extract_location(sequence, parse_location(location))
+
+
+def iterate_files_cds(input_fps, fast, threads):
+    if threads == 1:
+        for input_fp in input_fps:
+            with input_fp.open('rb' if fast else 'r') as fh:
+                yield from iterate_cds_fast(fh) if fast else iterate_cds(fh)
+        return
+
+    # Files are parsed in a process pool with a limited number in flight to bound memory
+    with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+        jobs = collections.deque()
+        for input_fp in input_fps:
+            jobs.append(executor.submit(get_file_cds, input_fp, fast))
+            if len(jobs) >= threads * 2:
+                yield from jobs.popleft().result()
+        while jobs:
+            yield from jobs.popleft().result()
+
+
+def get_file_cds(input_fp, fast):
+    with input_fp.open('rb' if fast else 'r') as fh:
+        return list(iterate_cds_fast(fh) if fast else iterate_cds(fh))
+
+
+def iterate_cds(fh):
+    for genbank_record in Bio.SeqIO.parse(fh, 'genbank'):
+        for feature in genbank_record.features:
+            if feature.type != 'CDS':
+                continue
+            name = str()
+            for qualifier in NAME_QUALIFIERS:
+                if qualifier in feature.qualifiers:
+                    name = feature.qualifiers[qualifier][0]
+                    break
+            sequence = feature.extract(genbank_record).seq
+            yield name, genbank_record.name, bytes(sequence)
+
+
+def iterate_cds_fast(fh):
+    for record_name, cds_lines_all, sequence_lines, _ in iterate_records_fast(fh):
+        sequence = clean_origin_sequence(b''.join(sequence_lines))
+        for cds_lines in cds_lines_all:
+            location, qualifiers = parse_feature_lines(cds_lines)
+            yield get_cds_name(qualifiers), record_name, extract_location(sequence, parse_location(location))
+
+
+def iterate_records_fast(fh):
+    # Only CDS lines from the feature table and the ORIGIN block are retained for each record
+    section = None
+    offset = 0
+    for line in fh:
+        if line.startswith(b'LOCUS'):
+            record_name = line.split()[1].decode()
+            cds_lines_all = list()
+            sequence_lines = list()
+            origin_start = None
+            section = None
+        elif line.startswith(b'FEATURES'):
+            section = 'features'
+        elif line.startswith(b'ORIGIN'):
+            section = 'origin'
+            origin_start = offset + len(line)
+        elif line.startswith(b'//'):
+            # Records such as WGS masters list contigs in place of an ORIGIN block
+            if origin_start is None and cds_lines_all:
+                raise ValueError('Record %s has CDS features but no sequence' % record_name)
+            origin_range = (offset if origin_start is None else origin_start, offset)
+            yield record_name, cds_lines_all, sequence_lines, origin_range
+            section = None
+        elif section == 'origin':
+            sequence_lines.append(line)
+        elif section == 'features':
+            # Feature keys start at column six, anything not indented ends the feature table
+            if line[:1] != b' ':
+                section = None
+            elif line[5:6] != b' ':
+                cds_lines = list() if line[5:21].strip() == b'CDS' else None
+                if cds_lines is not None:
+                    cds_lines_all.append(cds_lines)
+                    cds_lines.append(line[21:].decode().strip())
+            elif cds_lines is not None and line.strip():
+                cds_lines.append(line[21:].decode().strip())
+        offset += len(line)
+
+
+def clean_origin_sequence(origin):
+    return origin.translate(None, b' \t\r\n0123456789').upper()
+
+
+def get_cds_name(qualifiers):
+    for qualifier in NAME_QUALIFIERS:
+        if qualifier in qualifiers:
+            return qualifiers[qualifier]
+    return str()
+
+
+def parse_feature_lines(lines):
+    # Location may be split over several lines
+    line_iter = iter(lines)
+    location = next(line_iter)
+    while location.endswith(',') or location.count('(') > location.count(')'):
+        location += next(line_iter)
+
+    # Collect first value of naming qualifiers; multiline values are joined with spaces
+    qualifier_lines = dict()
+    value_lines = None
+    for line in line_iter:
+        if line.startswith('/'):
+            key, _, value = line[1:].partition('=')
+            value_lines = None
+            if key in NAME_QUALIFIERS and key not in qualifier_lines:
+                value_lines = qualifier_lines[key] = [value]
+        elif value_lines is not None:
+            value_lines.append(line)
+    qualifiers = dict()
+    for key, value_lines in qualifier_lines.items():
+        value = ' '.join(value_lines)
+        if len(value) > 1 and value[0] == '"' and value[-1] == '"':
+            value = value[1:-1]
+        qualifiers[key] = value.replace('""', '"')
+    return location.replace(' ', ''), qualifiers
+
+
+def parse_location(location):
+    # Returns parts as (start, end, strand) in the order they are to be extracted
+    if location.startswith('complement('):
+        return [(start, end, -strand) for start, end, strand in parse_location(location[11:-1])][::-1]
+    elif location.startswith(('join(', 'order(')):
+        inner = location[location.index('(')+1:-1]
+        return [part for token in split_location(inner) for part in parse_location(token)]
+    elif ':' in location:
+        raise ValueError('Remote locations are not supported: %s' % location)
+    location = location.replace('<', '').replace('>', '')
+    if '..' in location:
+        start, end = location.split('..')
+        return [(int(start) - 1, int(end), 1)]
+    elif '^' in location:
+        start = int(location.split('^')[0])
+        return [(start, start, 1)]
+    else:
+        return [(int(location) - 1, int(location), 1)]
+
+
+def split_location(location):
+    # Split on commas that are not nested within parentheses
+    tokens = list()
+    depth = token_start = 0
+    for i, char in enumerate(location):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and not depth:
+            tokens.append(location[token_start:i])
+            token_start = i + 1
+    tokens.append(location[token_start:])
+    return tokens
+
+
+def extract_location(sequence, parts):
+    part_sequences = list()
+    for start, end, strand in parts:
+        if strand == 1:
+            part_sequences.append(sequence[start:end])
+        else:
+            part_sequences.append(sequence[start:end][::-1].translate(COMPLEMENT))
+    return b''.join(part_sequences)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,154 @@
+'''FASTA reading and writing shared by scripts in data_extraction'''
+
+
+import collections
+import concurrent.futures
+import functools
+import gzip
+import io
+import zlib
+
+
+# Block sizes for reading input and writing output
+READ_BLOCK_SIZE = 4 * 1024 * 1024
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+class FastaWriter:
+    '''Write FASTA records with wrapped sequence, collecting output into large blocks'''
+
+    def __init__(self, fh, line_width=80, buffer_size=WRITE_BUFFER_SIZE):
+        self.fh = fh
+        self.line_width = line_width
+        self.buffer_size = buffer_size
+        self.buffer = list()
+        self.buffer_length = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def write(self, desc, seq):
+        record = format_fasta_record(desc, seq, self.line_width)
+        self.buffer.append(record)
+        self.buffer_length += len(record)
+        if self.buffer_length >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.fh.write(b''.join(self.buffer))
+        self.fh.flush()
+        self.buffer.clear()
+        self.buffer_length = 0
+
+
+class BgzfReader(io.RawIOBase):
+    '''Read a BGZF file, decompressing blocks in parallel with a thread pool (zlib releases the GIL)'''
+
+    def __init__(self, input_fp, threads):
+        self.fh = input_fp.open('rb')
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.blocks = self._decompress_blocks(threads * 8)
+        self.block = bytes()
+        self.block_offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.block_offset >= len(self.block):
+            self.block = next(self.blocks, None)
+            self.block_offset = 0
+            if self.block is None:
+                self.block = bytes()
+                return 0
+        size = min(len(buffer), len(self.block) - self.block_offset)
+        buffer[:size] = self.block[self.block_offset:self.block_offset+size]
+        self.block_offset += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.executor.shutdown(cancel_futures=True)
+            self.fh.close()
+        super().close()
+
+    def _read_blocks(self):
+        while True:
+            header = self.fh.read(12)
+            if not header:
+                return
+            # Block size is stored in the 'BC' extra subfield
+            extra = self.fh.read(int.from_bytes(header[10:12], 'little'))
+            bsize_index = extra.find(b'BC\x02\x00')
+            if header[:4] != b'\x1f\x8b\x08\x04' or bsize_index == -1:
+                raise ValueError('%s is not a valid BGZF file' % self.fh.name)
+            block_size = int.from_bytes(extra[bsize_index+4:bsize_index+6], 'little') + 1
+            # Compressed data is followed by CRC32 and input size
+            yield self.fh.read(block_size - len(header) - len(extra))[:-8]
+
+    def _decompress_blocks(self, queue_size):
+        # Limit blocks in flight so that memory stays bounded
+        jobs = collections.deque()
+        for block_data in self._read_blocks():
+            jobs.append(self.executor.submit(zlib.decompress, block_data, -15))
+            if len(jobs) >= queue_size:
+                yield jobs.popleft().result()
+        while jobs:
+            yield jobs.popleft().result()
+
+
+def read_fasta(fh):
+    # Split blocks on a newline followed by '>', carrying any partial record into the next block
+    parts = [b'\n']
+    preamble = True
+    for block in iter(functools.partial(fh.read, READ_BLOCK_SIZE), b''):
+        if block.find(b'\n>') == -1 and not (parts[-1].endswith(b'\n') and block.startswith(b'>')):
+            parts.append(block)
+            continue
+        records = b''.join(parts + [block]).split(b'\n>')
+        parts = [records.pop()]
+        # Text preceding the first header is ignored
+        if preamble:
+            records = records[1:]
+            preamble = False
+        yield from (parse_fasta_record(record) for record in records)
+    if not preamble:
+        yield parse_fasta_record(b''.join(parts))
+
+
+def parse_fasta_record(record):
+    header, _, seq = record.partition(b'\n')
+    return header.rstrip(), seq.translate(None, b' \t\r\n')
+
+
+def format_fasta_record(desc, seq, line_width=80):
+    if isinstance(desc, str):
+        desc = desc.encode()
+    if isinstance(seq, str):
+        seq = seq.encode()
+    lines = [seq[i:i+line_width] for i in range(0, len(seq), line_width)]
+    lines.append(bytes())
+    return b'>' + desc + b'\n' + b'\n'.join(lines)
+
+
+def open_input(input_fp, threads=1):
+    # Detect gzip by magic number; BGZF is gzip with a 'BC' extra subfield
+    if not is_compressed(input_fp):
+        return input_fp.open('rb')
+    with input_fp.open('rb') as fh:
+        header = fh.read(16)
+    if threads > 1 and header[3] & 4 and header[12:14] == b'BC':
+        return io.BufferedReader(BgzfReader(input_fp, threads), READ_BLOCK_SIZE)
+    else:
+        return gzip.open(input_fp, 'rb')
+
+
+def is_compressed(input_fp):
+    # Pipes and other streams can't be sniffed without consuming them
+    if not input_fp.is_file():
+        return False
+    with input_fp.open('rb') as fh:
+        return fh.read(2) == b'\x1f\x8b'
@@ -1,36 +1,173 @@
 #!/usr/bin/env python3
 '''Translate nucleotide FASTA records'''
 import argparse
+import collections
+import concurrent.futures
+import itertools
 import pathlib
+import sys
 
 
+from Bio.Data import CodonTable
 from Bio.Seq import Seq
-from Bio.SeqIO.FastaIO import SimpleFastaParser
+import numpy as np
+
+
+from fasta_io import FastaWriter, open_input, read_fasta
+
+
+# Records are translated together in batches of roughly this many bases
+BATCH_BASES = 1024 * 1024
+
+# Nucleotide and ambiguity codes accepted in codons, with gaps so that aligned sequences translate '---' to '-'
+CODON_NUCLEOTIDES = 'ACGTURYKMSWBDHVN-'
+
+COMPLEMENT = bytes.maketrans(b'ACGTURYKMBVDHSWNacgturykmbvdhswn', b'TGCAAYRMKVBHDSWNtgcaayrmkvbhdswn')
+
+
+class CodonTranslator:
+    '''Translate nucleotide sequences through a codon lookup table over byte arrays'''
+
+    def __init__(self, table_id=1):
+        # Nucleotides are given five bit codes, with zero reserved for invalid characters
+        self.nucleotide_codes = np.zeros(256, dtype=np.uint16)
+        for code, nucleotide in enumerate(CODON_NUCLEOTIDES, 1):
+            self.nucleotide_codes[ord(nucleotide)] = code
+            self.nucleotide_codes[ord(nucleotide.lower())] = code
+
+        # Resolve every codon once with Biopython so that ambiguous codons translate identically
+        self.codon_table = np.zeros(32 ** 3, dtype=np.uint8)
+        for codon in itertools.product(CODON_NUCLEOTIDES, repeat=3):
+            try:
+                amino_acid = str(Seq(''.join(codon)).translate(table=table_id))
+            except CodonTable.TranslationError:
+                continue
+            self.codon_table[self._get_codon_index(codon)] = ord(amino_acid)
+
+    def _get_codon_index(self, codon):
+        codes = [self.nucleotide_codes[ord(nucleotide)] for nucleotide in codon]
+        return codes[0] << 10 | codes[1] << 5 | codes[2]
+
+    def translate(self, seqs, stop_symbol=b'*'):
+        # Trailing partial codons are dropped, then all sequences are translated at once
+        seqs = [seq[:len(seq) - len(seq) % 3] for seq in seqs]
+        nucleotides = self.nucleotide_codes[np.frombuffer(b''.join(seqs), dtype=np.uint8)]
+        codons = nucleotides[0::3] << 10 | nucleotides[1::3] << 5 | nucleotides[2::3]
+        amino_acids = self.codon_table[codons]
+        if not amino_acids.all():
+            codon_index = int(np.argmin(amino_acids)) * 3
+            codon = b''.join(seqs)[codon_index:codon_index+3].decode()
+            raise CodonTable.TranslationError('Codon \'%s\' is invalid' % codon)
+
+        # Split back into individual proteins
+        proteins = amino_acids.tobytes()
+        if stop_symbol != b'*':
+            proteins_split = list()
+            for protein in self._split_proteins(proteins, seqs):
+                proteins_split.append(protein.replace(b'*', stop_symbol))
+            return proteins_split
+        return list(self._split_proteins(proteins, seqs))
+
+    def _split_proteins(self, proteins, seqs):
+        offset = 0
+        for seq in seqs:
+            yield proteins[offset:offset+len(seq)//3]
+            offset += len(seq) // 3
 
 
 def get_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_fp', required=True, type=pathlib.Path,
-            help='Input nucleotide FASTA filepath')
+            help='Input nucleotide FASTA filepath, optionally gzip or BGZF compressed')
+    parser.add_argument('--decompress_threads', type=int, default=1,
+            help='Number of threads to decompress BGZF input with [default: 1]')
+    parser.add_argument('--table', type=int, default=1,
+            help='NCBI genetic code table [default: 1]')
+    parser.add_argument('--six_frame', action='store_true',
+            help='Translate all six reading frames, with frames 4-6 on the reverse strand')
+    parser.add_argument('--threads', type=int, default=1,
+            help='Number of processes to translate batches of records with [default: 1]')
 
     args = parser.parse_args()
     if not args.input_fp.exists():
         parser.error('Input file %s does not exist' % args.input_fp)
+    if args.table not in CodonTable.unambiguous_dna_by_id:
+        parser.error('Unknown NCBI genetic code table %s' % args.table)
+    if args.threads < 1:
+        parser.error('--threads must be at least 1')
+    if args.decompress_threads < 1:
+        parser.error('--decompress_threads must be at least 1')
     return args
 
 
 def main():
-    # Read in data
+    # Get command line arguments
     args = get_arguments()
-    with args.input_fp.open('r') as fh:
-        fastas = [(desc, Seq(seq)) for desc, seq in SimpleFastaParser(fh)]
-
-    # Translate and write out
-    for desc, seq_obj in fastas:
-        print('>', desc, sep='')
-        seq = seq_obj.translate(stop_symbol='')
-        for line in [seq[i:i+80] for i in range(0, len(seq), 80)]:
-            print(line)
+
+    # Stream batches of records through translation so that memory use does not grow with input size
+    with open_input(args.input_fp, args.decompress_threads) as fh, FastaWriter(sys.stdout.buffer) as writer:
+        batches = iterate_batches(read_fasta(fh))
+        if args.threads == 1:
+            translator = CodonTranslator(args.table)
+            translated_batches = (translate_batch(translator, records, args.six_frame) for records in batches)
+        else:
+            translated_batches = translate_batches_parallel(batches, args.table, args.six_frame, args.threads)
+        for translated_records in translated_batches:
+            for desc, protein in translated_records:
+                writer.write(desc, protein)
+
+
+def translate_batches_parallel(batches, table_id, six_frame, threads):
+    # Batches in flight are limited to bound memory, and results are yielded in input order
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=threads,
+            initializer=initialise_worker, initargs=(table_id, ))
+    with executor:
+        jobs = collections.deque()
+        for records in batches:
+            jobs.append(executor.submit(translate_batch_worker, records, six_frame))
+            if len(jobs) >= threads * 2:
+                yield jobs.popleft().result()
+        while jobs:
+            yield jobs.popleft().result()
+
+
+def initialise_worker(table_id):
+    global worker_translator
+    worker_translator = CodonTranslator(table_id)
+
+
+def translate_batch_worker(records, six_frame):
+    return translate_batch(worker_translator, records, six_frame)
+
+
+def translate_batch(translator, records, six_frame):
+    if six_frame:
+        records = [frame for desc, seq in records for frame in get_six_frames(desc, seq)]
+    descs, seqs = zip(*records)
+    return list(zip(descs, translator.translate(seqs, stop_symbol=b'')))
+
+
+def iterate_batches(records):
+    batch = list()
+    batch_bases = 0
+    for desc, seq in records:
+        batch.append((desc, seq))
+        batch_bases += len(seq)
+        if batch_bases >= BATCH_BASES:
+            yield batch
+            batch = list()
+            batch_bases = 0
+    if batch:
+        yield batch
+
+
+def get_six_frames(desc, seq):
+    # Frame number is appended to the record name
+    name, _, comment = desc.partition(b' ')
+    seq_rc = seq[::-1].translate(COMPLEMENT)
+    for frame, frame_seq in enumerate((seq, seq[1:], seq[2:], seq_rc, seq_rc[1:], seq_rc[2:]), 1):
+        frame_desc = b'%s_%d %s' % (name, frame, comment) if comment else b'%s_%d' % (name, frame)
+        yield frame_desc, frame_seq
 
 
 if __name__ == '__main__':
@@ -1,21 +1,71 @@
 #!/usr/bin/env python3
-'''Convert an EMBOSS distmat to an ordered square matrix'''
+'''Convert an EMBOSS distmat to an ordered square matrix, as TSV or PHYLIP'''
 import argparse
 import pathlib
+import sys
+
+
+import numpy as np
+
+
+class CondensedMatrix:
+    '''Memory-mapped float32 condensed upper triangle with OTU ids in a sidecar file'''
+
+    def __init__(self, prefix):
+        with binary_ids_fp(prefix).open('r') as f:
+            self.otu_ids = [line.rstrip('\n') for line in f]
+        self.otu_indices = {otu_id: i for i, otu_id in enumerate(self.otu_ids)}
+        self.distances = np.memmap(binary_matrix_fp(prefix), dtype=np.float32, mode='r')
+        n = len(self.otu_ids)
+        if len(self.distances) != n * (n - 1) // 2:
+            raise ValueError('Matrix size does not match number of OTU ids for %s' % prefix)
+
+    def get_row(self, i, indices):
+        # Only the pages holding requested elements are read
+        row = np.array(self.distances[condensed_index(i, indices, len(self.otu_ids))])
+        row[indices == i] = 0
+        return row
 
 
 def get_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-m', '--matrix', required=True, type=pathlib.Path,
+    matrix = parser.add_mutually_exclusive_group(required=True)
+    matrix.add_argument('-m', '--matrix', type=pathlib.Path,
             help='Path to EMBOSS distance matrix')
-    parser.add_argument('-t', '--otu_ids', required=True, type=pathlib.Path,
+    matrix.add_argument('-b', '--binary', type=pathlib.Path,
+            help='Prefix of binary matrix written by --write_binary')
+    parser.add_argument('-t', '--otu_ids', type=pathlib.Path,
             help='File containing order of OTUs')
+    parser.add_argument('--rows', nargs='+',
+            help='Only output rows for these OTUs [default: OTUs in --otu_ids]')
+    parser.add_argument('--pair', nargs=2,
+            help='Print distance between a pair of OTUs in binary matrix')
+    parser.add_argument('--write_binary', type=pathlib.Path,
+            help='Convert distance matrix to binary format with this prefix and exit')
+    parser.add_argument('--stream_subset', action='store_true',
+            help='Read distance matrix once, retaining only OTUs in --otu_ids')
+    parser.add_argument('--phylip', action='store_true',
+            help='Write square matrix in PHYLIP format rather than TSV')
 
     args = parser.parse_args()
-    if not args.matrix.exists():
+    if args.matrix and not args.matrix.exists():
         parser.error('Input file %s does not exist' % args.matrix)
-    if not args.otu_ids.exists():
+    if args.binary and not binary_matrix_fp(args.binary).exists():
+        parser.error('Input file %s does not exist' % binary_matrix_fp(args.binary))
+    if args.otu_ids and not args.otu_ids.exists():
         parser.error('Input file %s does not exist' % args.otu_ids)
+    if args.write_binary and not args.matrix:
+        parser.error('--write_binary requires --matrix')
+    if args.pair and not args.binary:
+        parser.error('--pair requires --binary')
+    if args.matrix and not args.write_binary and not args.otu_ids:
+        parser.error('--otu_ids is required with --matrix')
+    if args.binary and not (args.otu_ids or args.rows or args.pair):
+        parser.error('--binary requires --otu_ids, --rows or --pair')
+    if args.stream_subset and not (args.matrix and args.otu_ids):
+        parser.error('--stream_subset requires --matrix and --otu_ids')
+    if args.phylip and args.rows:
+        parser.error('--phylip requires a square matrix and cannot be used with --rows')
 
     return args
 
@@ -24,58 +74,165 @@ def main():
     # Get commandline arguments
     args = get_arguments()
 
-    # Read in OTU ids
-    with args.otu_ids.open('r') as f:
-        ordered_otu_ids = [line.rstrip() for line in f]
+    # Convert once to binary
+    if args.write_binary:
+        with args.matrix.open('r') as f:
+            write_binary(f, args.write_binary)
+        return
 
-    # Read in distmat matrix
+    # Read in OTU ids
+    ordered_otu_ids = None
+    if args.otu_ids:
+        with args.otu_ids.open('r') as f:
+            ordered_otu_ids = [line.rstrip() for line in f]
+
+    # Serve from binary matrix
+    if args.binary:
+        matrix = CondensedMatrix(args.binary)
+        if args.pair:
+            i, j = get_indices(args.pair, matrix.otu_indices)
+            print(*args.pair, '%.2f' % matrix.get_row(i, np.array([j]))[0], sep='\t')
+            return
+        column_otu_ids = ordered_otu_ids if ordered_otu_ids else matrix.otu_ids
+        column_indices = get_indices(column_otu_ids, matrix.otu_indices)
+        row_otu_ids = args.rows if args.rows else column_otu_ids
+        row_indices = get_indices(row_otu_ids, matrix.otu_indices)
+        rows = (matrix.get_row(i, column_indices) for i in row_indices)
+        rows = ([b'%.2f' % d for d in row.tolist()] for row in rows)
+        write_matrix(row_otu_ids, column_otu_ids, rows, args.phylip)
+        return
+
+    # Single pass keeping only requested OTUs
+    if args.stream_subset:
+        with args.matrix.open('r') as f:
+            subset_matrix = read_distmat_subset(f, ordered_otu_ids)
+        write_matrix(ordered_otu_ids, ordered_otu_ids, (row.tolist() for row in subset_matrix), args.phylip)
+        return
+
+    # Read in distmat matrix as condensed upper triangle
     with args.matrix.open('r') as f:
-        # Skip irrelevant data
-        for i in range(8):
-            f.readline()
-
-        # Read in all lines
-        raw_data = [line.strip().split('\t') for line in f]
-
-    # Get OTU ids
-    row_info = [row[-1].split() for row in raw_data]
-    otu_ids, row_number = zip(*row_info)
-
-    # Get representation of just the rows
-    rows = [raw_row[:-2] for raw_row in raw_data]
-    elements = [el.strip() for row in rows for el in row if el != '0.00']
-
-    # Construct symmetric matrix
-    element_count = len(rows)
-
-    print('#OTU ID', *ordered_otu_ids, sep='\t')
-    for otu_id_one in ordered_otu_ids:
-        # Print row OTU ids
-        print(otu_id_one, end='')
-
-        for otu_id_two in ordered_otu_ids:
-            # If we're on diagonal, print 0.00 and continue to next element
-            if otu_id_one == otu_id_two:
-                print('\t0.00', sep='', end='')
-                continue
-
-            # Get indices of OTUs
-            i = otu_ids.index(otu_id_one) + 1
-            j = otu_ids.index(otu_id_two) + 1
-
-            # Order indices so that we stay in the upper triangle
-            index_one, index_two = sorted([i, j])
-            index = linear_index(index_one, index_two, element_count)
-
-            # Print data
-            print('\t', elements[index], sep='', end='')
-
-        # Print new line
-        print('\n', end='')
-
-
-def linear_index(i, j, n):
-    return int((j + (i - 1) * n - (i * (i + 1)) / 2) - 1)
+        otu_ids, elements = read_distmat(f)
+
+    # Map OTU ids to matrix indices
+    otu_indices = {otu_id: i for i, otu_id in enumerate(otu_ids)}
+    column_indices = get_indices(ordered_otu_ids, otu_indices)
+    row_otu_ids = args.rows if args.rows else ordered_otu_ids
+    row_indices = get_indices(row_otu_ids, otu_indices)
+
+    # Construct each row of the reordered symmetric matrix with a single gather
+    rows = (get_row_elements(elements, i, column_indices, len(otu_ids)) for i in row_indices)
+    write_matrix(row_otu_ids, ordered_otu_ids, rows, args.phylip)
+
+
+def get_row_elements(elements, i, indices, n):
+    row = elements[condensed_index(i, indices, n)]
+    row[indices == i] = b'0.00'
+    return row.tolist()
+
+
+def get_indices(otu_ids, otu_indices):
+    otu_ids_missing = [otu_id for otu_id in otu_ids if otu_id not in otu_indices]
+    if otu_ids_missing:
+        print('Could not find: ', *otu_ids_missing, sep='\n', file=sys.stderr)
+        sys.exit(1)
+    return np.array([otu_indices[otu_id] for otu_id in otu_ids], dtype=np.int64)
+
+
+def write_matrix(row_otu_ids, column_otu_ids, rows, phylip=False):
+    # PHYLIP uses the relaxed format with whitespace separated names
+    if phylip:
+        print('%5d' % len(column_otu_ids))
+    else:
+        print('#OTU ID', *column_otu_ids, sep='\t')
+    sys.stdout.flush()
+    delimiter = b' ' if phylip else b'\t'
+    for otu_id, row in zip(row_otu_ids, rows):
+        sys.stdout.buffer.write(otu_id.encode() + delimiter + delimiter.join(row) + b'\n')
+
+
+def iterate_distmat_lines(f):
+    # Skip irrelevant data
+    for i in range(8):
+        f.readline()
+
+    # OTU id is the last field of each row
+    for line in f:
+        otu_id, row_number = line.rstrip('\n').rsplit('\t', 1)[-1].split()
+        yield otu_id, line
+
+
+def parse_distmat_elements(line):
+    # Each row holds upper triangle elements, starting at the diagonal, followed by the OTU id
+    line_tokens = line.rstrip('\n').split('\t')
+    elements = [token.strip() for token in line_tokens[:-1] if token.strip()]
+    return elements[1:]
+
+
+def iterate_distmat(f):
+    for otu_id, line in iterate_distmat_lines(f):
+        yield otu_id, parse_distmat_elements(line)
+
+
+def read_distmat_subset(f, otu_ids):
+    # Row elements of later OTUs can't be located until their ids are seen, so the upper triangle
+    # row of each requested OTU is kept in full
+    # An OTU listed more than once fills each of its positions
+    otu_positions = dict()
+    for position, otu_id in enumerate(otu_ids):
+        otu_positions.setdefault(otu_id, list()).append(position)
+    rows = dict()
+    row_indices = dict()
+    for i, (otu_id, line) in enumerate(iterate_distmat_lines(f)):
+        if otu_id not in otu_positions:
+            continue
+        rows[otu_id] = np.array(parse_distmat_elements(line), dtype=np.bytes_)
+        row_indices[otu_id] = i
+    get_indices(otu_ids, row_indices)
+
+    # Fill subset matrix from each row of the upper triangle
+    element_width = max([4] + [row.dtype.itemsize for row in rows.values()])
+    subset_matrix = np.full((len(otu_ids), len(otu_ids)), b'0.00', dtype='S%d' % element_width)
+    subset_indices = np.array([row_indices[otu_id] for otu_id in otu_ids], dtype=np.int64)
+    for otu_id, row in rows.items():
+        i = row_indices[otu_id]
+        later = subset_indices > i
+        elements = row[subset_indices[later] - i - 1]
+        for position in otu_positions[otu_id]:
+            subset_matrix[position, later] = elements
+            subset_matrix[later, position] = elements
+    return subset_matrix
+
+
+def read_distmat(f):
+    otu_ids = list()
+    row_elements = list()
+    for otu_id, elements in iterate_distmat(f):
+        otu_ids.append(otu_id)
+        row_elements.append(np.array(elements, dtype=np.bytes_))
+    return otu_ids, np.concatenate(row_elements)
+
+
+def write_binary(f, prefix):
+    # Rows are streamed straight to disk so only one is held at a time
+    with binary_matrix_fp(prefix).open('wb') as matrix_fh, binary_ids_fp(prefix).open('w') as ids_fh:
+        for otu_id, elements in iterate_distmat(f):
+            print(otu_id, file=ids_fh)
+            np.array(elements, dtype=np.float32).tofile(matrix_fh)
+
+
+def binary_matrix_fp(prefix):
+    return prefix.with_name(prefix.name + '.f32')
+
+
+def binary_ids_fp(prefix):
+    return prefix.with_name(prefix.name + '.ids')
+
+
+def condensed_index(i, j, n):
+    # Zero-based index into the upper triangle for i != j, in either order
+    lo = np.minimum(i, j)
+    hi = np.maximum(i, j)
+    return lo * n - lo * (lo + 1) // 2 + hi - lo - 1
 
 
 if __name__ == '__main__':
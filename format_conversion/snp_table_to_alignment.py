@@ -1,18 +1,38 @@
 #!/usr/bin/env python3
-'''Convert a RedDog SNP table to an alignment in FASTA format'''
+'''Convert a RedDog SNP table to an alignment in FASTA format, optionally compressed to unique site patterns'''
 
 
 import argparse
 import pathlib
+import sys
+import tempfile
+
+
+import numpy as np
+
+
+# FASTA writing is shared with the data_extraction scripts
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / 'data_extraction'))
+from fasta_io import FastaWriter
 
 
 def get_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('--input_fp', required=True, type=pathlib.Path,
             help='Input snp table')
+    parser.add_argument('--memory_limit', type=int, default=1024,
+            help='Approximate memory in MB for allele data, beyond which a disk memmap is used [default: 1024]')
+    parser.add_argument('--temp_dir', type=pathlib.Path,
+            help='Directory for the allele memmap [default: system temporary directory]')
+    parser.add_argument('--compress_patterns', type=pathlib.Path,
+            help='Collapse identical sites, writing <prefix>.weights and <prefix>.patterns.tsv')
     args = parser.parse_args()
     if not args.input_fp.exists():
         parser.error('Input file %s does not exist' % args.input_fp)
+    if args.memory_limit < 1:
+        parser.error('--memory_limit must be at least 1')
+    if args.temp_dir and not args.temp_dir.exists():
+        parser.error('Directory %s does not exist' % args.temp_dir)
 
     return args
 
@@ -21,20 +41,83 @@ def main():
     # Get command line arguments
     args = get_arguments()
 
-    with args.input_fp.open('r') as fh:
-        header_tokens = fh.readline().rstrip().split(',')
-        isolates = header_tokens[1:]
+    # Compress to unique site patterns in a single pass
+    if args.compress_patterns:
+        with args.input_fp.open('rb') as fh:
+            isolates = fh.readline().decode().rstrip().split(',')[1:]
+            alleles, pattern_positions = collapse_site_patterns(fh, len(isolates))
+        with args.compress_patterns.with_name(args.compress_patterns.name + '.weights').open('w') as weights_fh:
+            for positions in pattern_positions:
+                print(len(positions), file=weights_fh)
+        with args.compress_patterns.with_name(args.compress_patterns.name + '.patterns.tsv').open('w') as map_fh:
+            print('pattern', 'positions', sep='\t', file=map_fh)
+            for pattern_number, positions in enumerate(pattern_positions, 1):
+                print(pattern_number, ','.join(positions), sep='\t', file=map_fh)
+        write_alignment(isolates, alleles, args.memory_limit * 1024 * 1024)
+        return
+
+    # Pack alleles into a sites by isolates uint8 array, held on disk if larger than the memory limit
+    memory_limit = args.memory_limit * 1024 * 1024
+    in_memory = args.input_fp.stat().st_size // 2 <= memory_limit
+    with args.input_fp.open('rb') as fh, tempfile.TemporaryFile(dir=args.temp_dir) as temp_fh:
+        isolates = fh.readline().decode().rstrip().split(',')[1:]
+        alleles = pack_alleles(fh, len(isolates), None if in_memory else temp_fh)
+        write_alignment(isolates, alleles, memory_limit)
+
+
+def write_alignment(isolates, alleles, memory_limit):
+    if not len(alleles):
+        return
+
+    # Transpose blocks of isolate columns that fit within the memory limit
+    block_width = max(1, memory_limit // len(alleles))
+    with FastaWriter(sys.stdout.buffer) as writer:
+        for block_start in range(0, len(isolates), block_width):
+            block = np.ascontiguousarray(alleles[:, block_start:block_start+block_width].T)
+            for isolate, snps in zip(isolates[block_start:], block):
+                writer.write(isolate, snps.tobytes())
+
+
+def pack_alleles(fh, isolate_number, temp_fh=None):
+    packed = bytearray()
+    site_number = 0
+    for line_number, line in enumerate(fh, 2):
+        position, site_alleles = parse_site(line, isolate_number, line_number)
+        if temp_fh is None:
+            packed.extend(site_alleles)
+        else:
+            temp_fh.write(site_alleles)
+        site_number += 1
+    if temp_fh is None:
+        return np.frombuffer(packed, dtype=np.uint8).reshape(site_number, isolate_number)
+    temp_fh.flush()
+    if not site_number:
+        return np.empty((0, isolate_number), dtype=np.uint8)
+    return np.memmap(temp_fh, dtype=np.uint8, mode='r', shape=(site_number, isolate_number))
+
+
+def collapse_site_patterns(fh, isolate_number):
+    # Patterns are kept in order of first occurrence, with the positions of each
+    pattern_positions = dict()
+    for line_number, line in enumerate(fh, 2):
+        position, site_alleles = parse_site(line, isolate_number, line_number)
+        try:
+            pattern_positions[site_alleles].append(position)
+        except KeyError:
+            pattern_positions[site_alleles] = [position]
+    packed = b''.join(pattern_positions)
+    alleles = np.frombuffer(packed, dtype=np.uint8).reshape(len(pattern_positions), isolate_number)
+    return alleles, list(pattern_positions.values())
 
-        # Group SNP data by isolate
-        line_token_gen = (line.rstrip().split(',') for line in fh)
-        position_snp_gen = (lts[1:] for lts in line_token_gen)
-        isolate_snp_gen = zip(*position_snp_gen)
 
-        # Print out SNP alignments
-        for isolate, snps in zip(isolates, isolate_snp_gen):
-            print('>', isolate, sep='')
-            for line in [snps[i:i+80] for i in range(0, len(snps), 80)]:
-                print(*line, sep='')
+def parse_site(line, isolate_number, line_number):
+    # Each line holds one allele character per isolate after the position column
+    position, site_alleles = line.rstrip().split(b',', 1)
+    site_alleles = site_alleles.replace(b',', b'')
+    if len(site_alleles) != isolate_number:
+        print('Expected %s single character alleles on line %s' % (isolate_number, line_number), file=sys.stderr)
+        sys.exit(1)
+    return position.decode(), site_alleles
 
 
 if __name__ == '__main__':
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+'''Calculate pairwise SNP distances between isolates in a RedDog SNP table'''
+
+
+import argparse
+import collections
+import concurrent.futures
+import pathlib
+import sys
+import tempfile
+
+
+import numpy as np
+
+
+# Sites are read and packed into bits in chunks of this many rows, a multiple of 64
+CHUNK_SITES = 64 * 1024
+# Isolates compared per tile, and 64-bit words of sites per tile pass
+BLOCK_ISOLATES = 16
+BLOCK_WORDS = 512
+
+# Nucleotides are encoded in two bit planes with a third marking called sites, anything else is missing
+NUCLEOTIDE_CODES = {b'A': 0, b'C': 1, b'G': 2, b'T': 3}
+HIGH_BIT = np.zeros(256, dtype=bool)
+LOW_BIT = np.zeros(256, dtype=bool)
+CALLED = np.zeros(256, dtype=bool)
+for nucleotide, code in NUCLEOTIDE_CODES.items():
+    HIGH_BIT[ord(nucleotide)] = code >> 1
+    LOW_BIT[ord(nucleotide)] = code & 1
+    CALLED[ord(nucleotide)] = True
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_fp', required=True, type=pathlib.Path,
+            help='Input SNP table')
+    parser.add_argument('--write_binary', type=pathlib.Path,
+            help='Write condensed matrix with this prefix, readable by emboss_distmat_to_tsv.py --binary')
+    parser.add_argument('--threads', type=int, default=1,
+            help='Number of processes to compare isolates with [default: 1]')
+    parser.add_argument('--temp_dir', type=pathlib.Path,
+            help='Directory for bitsets shared with worker processes [default: system temporary directory]')
+    args = parser.parse_args()
+    if not args.input_fp.exists():
+        parser.error('Input file %s does not exist' % args.input_fp)
+    if args.threads < 1:
+        parser.error('--threads must be at least 1')
+    if args.temp_dir and not args.temp_dir.exists():
+        parser.error('Directory %s does not exist' % args.temp_dir)
+
+    return args
+
+
+def main():
+    # Get command line arguments
+    args = get_arguments()
+
+    # Encode alleles of each isolate as bitsets over sites
+    with args.input_fp.open('rb') as fh:
+        isolates = fh.readline().decode().rstrip().split(',')[1:]
+        bitsets = encode_bitsets(fh, len(isolates))
+
+    # Compare isolates, receiving upper triangle rows in order
+    with tempfile.NamedTemporaryFile(dir=args.temp_dir, suffix='.npy') as temp_fh:
+        if args.threads > 1:
+            np.save(temp_fh, bitsets)
+            temp_fh.flush()
+            row_blocks = compare_parallel(temp_fh.name, len(isolates), args.threads)
+        else:
+            row_blocks = (compare_block(bitsets, start) for start in range(0, len(isolates), BLOCK_ISOLATES))
+
+        if args.write_binary:
+            write_binary(isolates, row_blocks, args.write_binary)
+        else:
+            write_matrix(isolates, row_blocks)
+
+
+def encode_bitsets(fh, isolate_number):
+    # Bits are packed for a chunk of sites at a time so that only the chunk is held as bytes
+    planes = [list(), list(), list()]
+    for chunk in iterate_site_chunks(fh, isolate_number):
+        for plane, table in zip(planes, (HIGH_BIT, LOW_BIT, CALLED)):
+            plane.append(np.packbits(table[chunk], axis=0))
+
+    # Stack planes as isolates by 64-bit words, padding the final word with uncalled sites
+    byte_number = sum(len(plane_chunk) for plane_chunk in planes[0])
+    word_number = max(1, -(-byte_number // 8))
+    bitsets = np.zeros((3, isolate_number, word_number * 8), dtype=np.uint8)
+    for i, plane in enumerate(planes):
+        if plane:
+            bitsets[i, :, :byte_number] = np.concatenate(plane).T
+        plane.clear()
+    return bitsets.view(np.uint64)
+
+
+def iterate_site_chunks(fh, isolate_number):
+    packed = bytearray()
+    site_number = 0
+    for line_number, line in enumerate(fh, 2):
+        # Each line holds one allele character per isolate after the position column
+        site_alleles = line.rstrip().split(b',', 1)[1].replace(b',', b'')
+        if len(site_alleles) != isolate_number:
+            print('Expected %s single character alleles on line %s' % (isolate_number, line_number), file=sys.stderr)
+            sys.exit(1)
+        packed.extend(site_alleles)
+        site_number += 1
+        if site_number == CHUNK_SITES:
+            yield np.frombuffer(packed, dtype=np.uint8).reshape(site_number, isolate_number)
+            packed = bytearray()
+            site_number = 0
+    if site_number:
+        yield np.frombuffer(packed, dtype=np.uint8).reshape(site_number, isolate_number)
+
+
+def compare_parallel(bitsets_fp, isolate_number, threads):
+    # Workers map the saved bitsets so pages are shared, with blocks in flight bounded to keep rows ordered
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=threads,
+            initializer=initialise_worker, initargs=(bitsets_fp, ))
+    with executor:
+        jobs = collections.deque()
+        for start in range(0, isolate_number, BLOCK_ISOLATES):
+            jobs.append(executor.submit(compare_block_worker, start))
+            if len(jobs) >= threads * 2:
+                yield jobs.popleft().result()
+        while jobs:
+            yield jobs.popleft().result()
+
+
+def initialise_worker(bitsets_fp):
+    global worker_bitsets
+    worker_bitsets = np.load(bitsets_fp, mmap_mode='r')
+
+
+def compare_block_worker(start):
+    return compare_block(worker_bitsets, start)
+
+
+def compare_block(bitsets, start):
+    # Distances from a block of isolates to themselves and every later isolate, as upper triangle rows
+    isolate_number = bitsets.shape[1]
+    stop = min(start + BLOCK_ISOLATES, isolate_number)
+    counts = np.zeros((stop - start, isolate_number - start), dtype=np.int64)
+    for column_start in range(start, isolate_number, BLOCK_ISOLATES):
+        column_stop = min(column_start + BLOCK_ISOLATES, isolate_number)
+        counts[:, column_start-start:column_stop-start] = count_differences(
+                bitsets, slice(start, stop), slice(column_start, column_stop))
+    return [row[i+1:] for i, row in enumerate(counts)]
+
+
+def count_differences(bitsets, rows, columns):
+    # A site differs where either allele bit differs and both isolates have a call
+    high, low, called = bitsets
+    counts = 0
+    for word_start in range(0, bitsets.shape[2], BLOCK_WORDS):
+        words = slice(word_start, word_start + BLOCK_WORDS)
+        row_high, row_low, row_called = high[rows, None, words], low[rows, None, words], called[rows, None, words]
+        differences = np.bitwise_xor(row_high, high[None, columns, words])
+        differences |= np.bitwise_xor(row_low, low[None, columns, words])
+        differences &= row_called
+        differences &= called[None, columns, words]
+        counts = counts + popcount(differences).sum(axis=2, dtype=np.int64)
+    return counts
+
+
+def popcount(words):
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words)
+    # Older numpy has no popcount ufunc, count bits a byte at a time instead
+    return POPCOUNT_TABLE[words.view(np.uint8)]
+
+
+def write_matrix(isolates, row_blocks):
+    # Lower triangle elements come from earlier rows so the full matrix is assembled before writing
+    isolate_number = len(isolates)
+    matrix = np.zeros((isolate_number, isolate_number), dtype=np.int32)
+    i = 0
+    for rows in row_blocks:
+        for row in rows:
+            matrix[i, i+1:] = row
+            matrix[i+1:, i] = row
+            i += 1
+    print('#OTU ID', *isolates, sep='\t')
+    for isolate, row in zip(isolates, matrix):
+        sys.stdout.write(isolate + '\t' + '\t'.join(map(str, row.tolist())) + '\n')
+
+
+def write_binary(isolates, row_blocks, prefix):
+    # Same layout as emboss_distmat_to_tsv.py: float32 upper triangle rows and a sidecar of ids
+    with prefix.with_name(prefix.name + '.ids').open('w') as ids_fh:
+        print(*isolates, sep='\n', file=ids_fh)
+    with prefix.with_name(prefix.name + '.f32').open('wb') as matrix_fh:
+        for rows in row_blocks:
+            for row in rows:
+                row.astype(np.float32).tofile(matrix_fh)
+
+
+if __name__ == '__main__':
+    main()
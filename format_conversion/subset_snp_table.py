@@ -3,21 +3,77 @@
 
 
 import argparse
+import contextlib
+import os
 import pathlib
 import sys
 
 
+import numpy as np
+
+
+# Approximate size of allele data read per chunk of sites
+CHUNK_BYTES = 32 * 1024 * 1024
+
+
+class ColumnarSnpTable:
+    '''Memory-mapped SNP table stored as one allele column per sample, with positions and a header index'''
+
+    def __init__(self, prefix):
+        with columnar_index_fp(prefix).open('r') as f:
+            self.header_tokens = [line.rstrip('\n') for line in f]
+        self.column_indices = {name: i for i, name in enumerate(self.header_tokens[1:])}
+        self.positions = np.fromfile(columnar_positions_fp(prefix), dtype=np.int64)
+        shape = (len(self.column_indices), len(self.positions))
+        if columnar_alleles_fp(prefix).stat().st_size != shape[0] * shape[1]:
+            raise ValueError('Allele data size does not match sites and samples for %s' % prefix)
+        if self.positions.size:
+            self.alleles = np.memmap(columnar_alleles_fp(prefix), dtype=np.uint8, mode='r', shape=shape)
+        else:
+            self.alleles = np.empty(shape, dtype=np.uint8)
+
+    def get_columns(self, indices):
+        # Each column is contiguous on disk so only requested columns are read
+        alleles = np.empty((len(self.positions), len(indices)), dtype=np.uint8)
+        for i, index in enumerate(indices):
+            alleles[:, i] = self.alleles[index]
+        return alleles
+
+
 def get_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--input_fp', required=True, type=pathlib.Path,
+    table = parser.add_mutually_exclusive_group(required=True)
+    table.add_argument('--input_fp', type=pathlib.Path,
             help='Input SNP table')
-    parser.add_argument('--sample_names', required=True, nargs='+',
+    table.add_argument('--columnar', type=pathlib.Path,
+            help='Prefix of columnar SNP table written by --write_columnar')
+    samples = parser.add_mutually_exclusive_group()
+    samples.add_argument('--sample_names', nargs='+',
             help='Space-separated list of sample names to retain')
+    samples.add_argument('--manifest_fp', type=pathlib.Path,
+            help='Tab-separated file of output name and sample name, one sample per line')
+    parser.add_argument('--output_dir', type=pathlib.Path,
+            help='Directory to write <output name>.csv for each subset in --manifest_fp')
+    parser.add_argument('--write_columnar', type=pathlib.Path,
+            help='Convert SNP table to columnar format with this prefix and exit')
     args = parser.parse_args()
-    if not args.input_fp.exists():
+    if args.input_fp and not args.input_fp.exists():
         parser.error('Input file %s does not exist' % args.input_fp)
+    if args.columnar and not columnar_alleles_fp(args.columnar).exists():
+        parser.error('Input file %s does not exist' % columnar_alleles_fp(args.columnar))
+    if args.write_columnar and not args.input_fp:
+        parser.error('--write_columnar requires --input_fp')
+    if not args.write_columnar and not (args.sample_names or args.manifest_fp):
+        parser.error('--sample_names or --manifest_fp is required unless using --write_columnar')
+    if args.manifest_fp and not args.manifest_fp.exists():
+        parser.error('Input file %s does not exist' % args.manifest_fp)
+    if args.manifest_fp and not args.output_dir:
+        parser.error('--manifest_fp requires --output_dir')
+    if args.output_dir and not args.output_dir.exists():
+        parser.error('Directory %s does not exist' % args.output_dir)
     # We'll need --sample_names as a set later
-    args.sample_names = set(args.sample_names)
+    if args.sample_names:
+        args.sample_names = set(args.sample_names)
     return args
 
 
@@ -25,37 +81,183 @@ def main():
     # Get command line arguments
     args = get_arguments()
 
-    # Process SNP table
-    with args.input_fp.open('r') as fh:
-        # Set up
-        line_token_gen = (line.rstrip().split(',') for line in fh)
-        header_tokens = next(line_token_gen)
-
-        # Get column indices - force 'Pos' and 'Ref'
-        indices = {0, 1}
-        samples_found = set()
-        for i, sample in enumerate(header_tokens[2:], 2):
-            if sample in args.sample_names:
-                indices.add(i)
-                samples_found.add(sample)
-
-        # Check for missing samples
-        samples_missing = samples_found - args.sample_names
-        if len(samples_missing) > 0:
-            print('Could not find: ', *samples_missing, sep='\n', file=sys.stderr)
+    # Convert once to columnar format
+    if args.write_columnar:
+        with args.input_fp.open('rb') as fh:
+            write_columnar(fh, args.write_columnar)
+        return
+
+    # Collect subsets, a single subset from --sample_names is written to stdout
+    if args.manifest_fp:
+        with args.manifest_fp.open('r') as fh:
+            subsets = read_manifest(fh)
+    else:
+        subsets = {None: args.sample_names}
+
+    with contextlib.ExitStack() as stack:
+        # Subset from columnar format, reading only the requested sample columns
+        if args.columnar:
+            table = ColumnarSnpTable(args.columnar)
+            subset_indices = {name: get_indices(table.header_tokens, samples) for name, samples in subsets.items()}
+            for name, indices in subset_indices.items():
+                output_fh = open_output(name, args.output_dir, stack)
+                alleles = table.get_columns([i - 1 for i in indices[1:]])
+                variant = get_variant_mask(alleles)
+                write_header(table.header_tokens, indices, output_fh)
+                write_sites(table.positions[variant], alleles[variant], output_fh)
+            return
+
+        # Process SNP table
+        with args.input_fp.open('rb') as fh:
+            # Set up, checking every subset before any output is written
+            header_tokens = fh.readline().decode().rstrip().split(',')
+            subset_indices = {name: get_indices(header_tokens, samples) for name, samples in subsets.items()}
+            subset_columns = dict()
+            for name, indices in subset_indices.items():
+                output_fh = open_output(name, args.output_dir, stack)
+                write_header(header_tokens, indices, output_fh)
+                subset_columns[output_fh] = [i - 1 for i in indices[1:]]
+
+            # Process data, each chunk is read once and shared by all subsets
+            for positions, chunk in iterate_site_chunks(fh, len(header_tokens) - 1):
+                for output_fh, columns in subset_columns.items():
+                    # Select only requested columns, check for variance across the whole chunk
+                    alleles = chunk[:, columns]
+                    variant = get_variant_mask(alleles)
+                    write_sites(positions[variant], alleles[variant], output_fh)
+
+
+def read_manifest(fh):
+    subsets = dict()
+    for line_number, line in enumerate(fh, 1):
+        if not line.strip():
+            continue
+        try:
+            name, sample = line.rstrip('\n').split('\t')
+        except ValueError:
+            print('Expected output name and sample name on line %s of manifest' % line_number, file=sys.stderr)
+            sys.exit(1)
+        # Output names become filenames in --output_dir, so can't contain a directory
+        if not name or os.sep in name or (os.altsep and os.altsep in name):
+            print('Invalid output name \'%s\' on line %s of manifest' % (name, line_number), file=sys.stderr)
             sys.exit(1)
+        if name not in subsets:
+            subsets[name] = set()
+        subsets[name].add(sample)
+    return subsets
+
+
+def open_output(name, output_dir, stack):
+    if name is None:
+        return sys.stdout.buffer
+    return stack.enter_context((output_dir / ('%s.csv' % name)).open('wb'))
+
+
+def get_indices(header_tokens, sample_names):
+    # Get column indices in table order - force 'Pos' and 'Ref'
+    indices = [0, 1]
+    samples_found = set()
+    for i, sample in enumerate(header_tokens[2:], 2):
+        if sample in sample_names:
+            indices.append(i)
+            samples_found.add(sample)
+
+    # Check for missing samples
+    samples_missing = sample_names - samples_found
+    if len(samples_missing) > 0:
+        print('Could not find: ', *samples_missing, sep='\n', file=sys.stderr)
+        sys.exit(1)
+    return indices
+
+
+def get_variant_mask(alleles):
+    # Sites are variant where any called allele differs from the first called allele
+    called = alleles != ord('-')
+    first_called = alleles[np.arange(len(alleles)), called.argmax(axis=1)]
+    return ((alleles != first_called[:, None]) & called).any(axis=1)
+
+
+def write_header(header_tokens, indices, fh):
+    fh.write(','.join(header_tokens[i] for i in indices).encode() + b'\n')
+
+
+def write_sites(positions, alleles, fh):
+    # Interleave allele bytes with delimiters so each row is formatted in one step
+    if not len(alleles):
+        return
+    rows = np.full((len(alleles), alleles.shape[1] * 2), ord(','), dtype=np.uint8)
+    rows[:, 0::2] = alleles
+    rows[:, -1] = ord('\n')
+    lines = (b'%d,' % position + row.tobytes() for position, row in zip(positions.tolist(), rows))
+    fh.write(b''.join(lines))
+
+
+def write_columnar(fh, prefix):
+    # Site number is counted first so that allele columns can be filled in place
+    header_tokens = fh.readline().decode().rstrip().split(',')
+    data_start = fh.tell()
+    site_number = sum(1 for line in fh)
+    fh.seek(data_start)
+    column_number = len(header_tokens) - 1
+    with columnar_index_fp(prefix).open('w') as index_fh:
+        print(*header_tokens, sep='\n', file=index_fh)
+    with columnar_positions_fp(prefix).open('wb') as positions_fh:
+        positions_fh.truncate(site_number * 8)
+    with columnar_alleles_fp(prefix).open('wb') as alleles_fh:
+        alleles_fh.truncate(site_number * column_number)
+    if not site_number:
+        return
+
+    # Transpose chunks of sites into the sample columns
+    positions = np.memmap(columnar_positions_fp(prefix), dtype=np.int64, mode='r+', shape=(site_number, ))
+    alleles = np.memmap(columnar_alleles_fp(prefix), dtype=np.uint8, mode='r+', shape=(column_number, site_number))
+    site_start = 0
+    for chunk_positions, chunk in iterate_site_chunks(fh, column_number):
+        site_stop = site_start + len(chunk)
+        positions[site_start:site_stop] = chunk_positions
+        alleles[:, site_start:site_stop] = chunk.T
+        site_start = site_stop
+    positions.flush()
+    alleles.flush()
+
+
+def iterate_site_chunks(fh, column_number):
+    positions = list()
+    packed = bytearray()
+    delimiters = b',' * (column_number - 1)
+    for line_number, line in enumerate(fh, 2):
+        # Each line holds one allele character per column after the position column, so alleles are
+        # every second byte with delimiters between
+        position, site_tokens = line.rstrip().split(b',', 1)
+        site_alleles = site_tokens[::2]
+        if len(site_alleles) != column_number or site_tokens[1::2] != delimiters:
+            print('Expected %s single character alleles on line %s' % (column_number, line_number), file=sys.stderr)
+            sys.exit(1)
+        positions.append(int(position))
+        packed.extend(site_alleles)
+        if len(packed) >= CHUNK_BYTES:
+            yield get_site_chunk(positions, packed, column_number)
+            positions = list()
+            packed = bytearray()
+    if positions:
+        yield get_site_chunk(positions, packed, column_number)
+
+
+def get_site_chunk(positions, packed, column_number):
+    positions = np.array(positions, dtype=np.int64)
+    return positions, np.frombuffer(packed, dtype=np.uint8).reshape(len(positions), column_number)
+
+
+def columnar_index_fp(prefix):
+    return prefix.with_name(prefix.name + '.index')
+
+
+def columnar_positions_fp(prefix):
+    return prefix.with_name(prefix.name + '.positions')
+
 
-        # Process data
-        header_data = [header_tokens[i] for i in indices]
-        print(*header_data, sep=',')
-        for line_tokens in line_token_gen:
-            # Select only requested columns, check for variance
-            data = [line_tokens[i] for i in indices]
-            alleles = set(data[1:])
-            if '-' in alleles: alleles.remove('-')
-            if len(alleles) <= 1:
-                continue
-            print(*data, sep=',')
+def columnar_alleles_fp(prefix):
+    return prefix.with_name(prefix.name + '.alleles')
 
 
 if __name__ == '__main__':
@@ -69,23 +69,101 @@ usa_nthi         GCA_002991485.1  public     144            38638    645.75   34
 
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import os
 import pathlib
 import math
-import statistics
+import sqlite3
 import sys
+import time
 
 
-from Bio.SeqIO.FastaIO import SimpleFastaParser
+import numpy as np
+
+
+# Columnar output is optional
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# FASTA reading is shared with the data_extraction scripts
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1] / 'data_extraction'))
+from fasta_io import READ_BLOCK_SIZE, open_input
+
+
+STATS_COLUMNS = ('contig_number', 'n50', 'q1', 'q2', 'q3', 'mean', 'smallest', 'largest', 'length')
+EXTENDED_STATS_COLUMNS = ('gc', 'n_count', 'ambiguous_count', 'l50', 'l90', 'ng50', 'aun')
+
+# Stats columns are untyped so that integer and float quartiles are returned as they were stored
+CACHE_KEY_COLUMNS = ('path', 'size', 'mtime_ns', 'inode', 'genome_size')
+CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS stats (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER,
+        genome_size INTEGER, %s);
+''' % ', '.join(STATS_COLUMNS + EXTENDED_STATS_COLUMNS)
+
+# Columns written as categorical or floating point in columnar output, all other stats are integers
+CATEGORICAL_COLUMNS = ('study', 'type')
+FLOAT_COLUMNS = ('q1', 'q2', 'q3', 'gc')
+ROW_GROUP_SIZE = 64 * 1024
+COLUMNAR_SUFFIXES = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# Residues counted by byte value, anything else that isn't whitespace is ambiguous
+GC_BYTES = b'GCgc'
+ACGT_BYTES = b'ACGTacgt'
+N_BYTES = b'Nn'
 
 
 def get_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('-a', '--assembly_fps', required=True, nargs='+', type=pathlib.Path,
-            help='Input FASTA files as space sperated list')
+            help='Input FASTA files as space sperated list, optionally gzip or BGZF compressed')
+    parser.add_argument('--decompress_threads', type=int, default=1,
+            help='Number of threads to decompress BGZF input with [default: 1]')
+    parser.add_argument('--threads', type=int, default=1,
+            help='Number of processes to calculate statistics for assemblies with [default: 1]')
+    parser.add_argument('--extended_metrics', action='store_true',
+            help='Also output GC%%, N and ambiguous base counts, L50, L90, NG50 and auN')
+    parser.add_argument('--genome_size', type=int,
+            help='Expected genome size in bp for NG50, which is NA without it')
+    parser.add_argument('--columnar_fp', type=pathlib.Path,
+            help='Write typed columnar output to this filepath rather than TSV to stdout')
+    parser.add_argument('--columnar_format', choices=('parquet', 'arrow'), default='parquet',
+            help='Format of columnar output, Parquet or Arrow IPC [default: parquet]')
+    parser.add_argument('--append', action='store_true',
+            help='Treat --columnar_fp as a dataset directory and add this run as a new part file')
+    parser.add_argument('--cache_fp', type=pathlib.Path,
+            help='SQLite cache of statistics, reused for assemblies whose resolved file is unchanged')
+    parser.add_argument('--invalidate_cache', action='store_true',
+            help='Recalculate statistics for all input assemblies, replacing any cached entries')
+    parser.add_argument('--prune_cache', action='store_true',
+            help='Remove cache entries for files that no longer exist or have changed')
     args = parser.parse_args()
     for assembly_fp in args.assembly_fps:
         if not assembly_fp.exists():
             parser.error('Input file %s does not exist' % assembly_fp)
+    if args.decompress_threads < 1:
+        parser.error('--decompress_threads must be at least 1')
+    if args.threads < 1:
+        parser.error('--threads must be at least 1')
+    if args.genome_size is not None and args.genome_size < 1:
+        parser.error('--genome_size must be at least 1')
+    if args.genome_size and not args.extended_metrics:
+        parser.error('--genome_size requires --extended_metrics')
+    if (args.invalidate_cache or args.prune_cache) and not args.cache_fp:
+        parser.error('--invalidate_cache and --prune_cache require --cache_fp')
+    if args.columnar_fp and pyarrow is None:
+        parser.error('--columnar_fp requires the pyarrow package, install with: pip install pyarrow')
+    if args.append and not args.columnar_fp:
+        parser.error('--append requires --columnar_fp')
+    if args.append and args.columnar_fp.exists() and not args.columnar_fp.is_dir():
+        parser.error('--append requires --columnar_fp to be a directory, %s is a file' % args.columnar_fp)
 
     return args
 
@@ -98,10 +176,29 @@ def main():
                  'hybrid_fixed': 'hybrid',
                  'hybrid': 'hybrid'}
 
-    header = ['study', 'assembly', 'type', 'contig_number', 'n50', 'q1', 'q2', 'q3', 'mean', 'smallest', 'largest', 'length']
-    print(*header, sep='\t')
-
-    for assembly_fp in args.assembly_fps:
+    stats_columns = STATS_COLUMNS + EXTENDED_STATS_COLUMNS if args.extended_metrics else STATS_COLUMNS
+    header = ['study', 'assembly', 'type', *stats_columns]
+
+    # Stats are served from the cache where possible, only changed assemblies are read
+    with contextlib.ExitStack() as stack:
+        cache = None
+        if args.cache_fp:
+            cache = stack.enter_context(open_stats_cache(args.cache_fp))
+            if args.prune_cache:
+                prune_stats_cache(cache)
+        assembly_stats = iterate_assembly_stats(args.assembly_fps, args.decompress_threads, args.threads,
+                args.extended_metrics, args.genome_size, cache, args.invalidate_cache)
+        rows = iterate_rows(args.assembly_fps, assembly_stats, type_dict, len(stats_columns))
+        if args.columnar_fp:
+            write_columnar(rows, header, args.columnar_fp, args.columnar_format, args.append)
+        else:
+            print(*header, sep='\t')
+            for row in rows:
+                print(*['NA' if value is None else value for value in row], sep='\t')
+
+
+def iterate_rows(assembly_fps, assembly_stats, type_dict, stats_number):
+    for assembly_fp, ordered_stats in zip(assembly_fps, assembly_stats):
         assembly_type = assembly_fp.resolve().parent.name[2:]
         try:
             assembly_type = type_dict[assembly_type]
@@ -109,62 +206,269 @@ def main():
             # Set ambiguous assembly types to MANUALFIX
             print('WARNING: unable to determine assembly type for', assembly_fp, file=sys.stderr)
             assembly_type = 'MANUALFIX'
-        ordered_stats = get_assembly_stats(assembly_fp)
         study = assembly_fp.parents[1].name
-        print(study, assembly_fp.stem, assembly_type, *ordered_stats, sep='\t')
-
-
-def get_assembly_stats(assembly_fp):
-    # Get contig lengths
-    with assembly_fp.open('r') as f:
-        contig_lengths = [len(s) for d, s in SimpleFastaParser(f)]
+        assembly = assembly_fp.stem
+        if assembly_fp.suffix in ('.gz', '.bgz'):
+            assembly = pathlib.Path(assembly).stem
+        yield (study, assembly, assembly_type, *ordered_stats[:stats_number])
+
+
+def write_columnar(rows, header, columnar_fp, columnar_format, append):
+    schema = get_columnar_schema(header)
+    output_fp = columnar_fp
+    if append:
+        # Parquet and Arrow files can't be extended in place, so each run adds a part file to the dataset
+        suffix = COLUMNAR_SUFFIXES[columnar_format]
+        columnar_fp.mkdir(parents=True, exist_ok=True)
+        for other_format, other_suffix in COLUMNAR_SUFFIXES.items():
+            if other_format != columnar_format and any(columnar_fp.glob('*' + other_suffix)):
+                print('%s contains %s parts, use a new dataset directory' % (columnar_fp, other_format), file=sys.stderr)
+                sys.exit(1)
+        for part_fp in sorted(columnar_fp.glob('*' + suffix)):
+            if not read_columnar_schema(part_fp, columnar_format).equals(schema):
+                print('Columns of %s differ from this run, use a new dataset directory' % part_fp, file=sys.stderr)
+                sys.exit(1)
+        output_fp = columnar_fp / ('%s_%d%s' % (time.strftime('%Y%m%d%H%M%S'), os.getpid(), suffix))
+
+    # Rows are written in row groups, or record batches for Arrow, as they arrive
+    if columnar_format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(output_fp, schema)
+    else:
+        writer = pyarrow.ipc.new_file(output_fp, schema)
+    with writer:
+        for rows_group in iterate_row_groups(rows, ROW_GROUP_SIZE):
+            arrays = [pyarrow.array(values, type=field.type) for values, field in zip(zip(*rows_group), schema)]
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+
+
+def get_columnar_schema(header):
+    fields = list()
+    for column in header:
+        if column in CATEGORICAL_COLUMNS:
+            fields.append(pyarrow.field(column, pyarrow.dictionary(pyarrow.int32(), pyarrow.string())))
+        elif column == 'assembly':
+            fields.append(pyarrow.field(column, pyarrow.string()))
+        elif column in FLOAT_COLUMNS:
+            fields.append(pyarrow.field(column, pyarrow.float64()))
+        else:
+            fields.append(pyarrow.field(column, pyarrow.int64()))
+    return pyarrow.schema(fields)
+
+
+def read_columnar_schema(columnar_fp, columnar_format):
+    if columnar_format == 'parquet':
+        return pyarrow.parquet.read_schema(columnar_fp)
+    with pyarrow.ipc.open_file(columnar_fp) as reader:
+        return reader.schema
+
+
+def iterate_row_groups(rows, group_size):
+    rows_group = list()
+    for row in rows:
+        rows_group.append(row)
+        if len(rows_group) >= group_size:
+            yield rows_group
+            rows_group = list()
+    if rows_group:
+        yield rows_group
+
+
+def iterate_assembly_stats(assembly_fps, decompress_threads, threads, extended=False, genome_size=None, cache=None,
+        invalidate=False):
+    if cache is None:
+        yield from calculate_assembly_stats(assembly_fps, decompress_threads, threads, extended, genome_size)
+        return
+
+    # Look up every assembly first so that only misses are sent for calculation
+    cache_keys = [(*get_file_key(assembly_fp), genome_size) for assembly_fp in assembly_fps]
+    if invalidate:
+        cached_stats = [None] * len(cache_keys)
+    else:
+        cached_stats = [read_cached_stats(cache, cache_key, extended) for cache_key in cache_keys]
+    missing_fps = [assembly_fp for assembly_fp, stats in zip(assembly_fps, cached_stats) if stats is None]
+    calculated_stats = calculate_assembly_stats(missing_fps, decompress_threads, threads, extended, genome_size)
+    for cache_key, stats in zip(cache_keys, cached_stats):
+        if stats is None:
+            stats = next(calculated_stats)
+            write_cached_stats(cache, cache_key, stats)
+        yield stats
+
+
+def calculate_assembly_stats(assembly_fps, decompress_threads, threads, extended=False, genome_size=None):
+    if threads == 1:
+        for assembly_fp in assembly_fps:
+            yield get_assembly_stats(assembly_fp, decompress_threads, extended, genome_size)
+        return
+
+    # Files in flight are limited to bound memory, and stats are yielded in argument order
+    with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+        jobs = collections.deque()
+        for assembly_fp in assembly_fps:
+            jobs.append(executor.submit(get_assembly_stats, assembly_fp, decompress_threads, extended, genome_size))
+            if len(jobs) >= threads * 2:
+                yield jobs.popleft().result()
+        while jobs:
+            yield jobs.popleft().result()
+
+
+def get_assembly_stats(assembly_fp, decompress_threads=1, extended=False, genome_size=None):
+    # Get contig lengths, and residue counts in the same pass for extended stats
+    with open_input(assembly_fp, decompress_threads) as fh:
+        contig_lengths, residue_counts = scan_contigs(fh, count_residues=extended)
+
+    # Sort lengths once as a compact array, shared by all length stats
+    lengths = np.array(contig_lengths, dtype=np.int64)
+    lengths.sort()
+    lengths_descending = lengths[::-1]
+    cumulative_lengths = np.cumsum(lengths_descending)
 
     # Calculate stats
     contig_number = len(contig_lengths)
-    length = sum(contig_lengths)
-    smallest = min(contig_lengths)
-    largest = max(contig_lengths)
-    mean = int(round(statistics.mean(contig_lengths), 0))
-    q1, q2, q3 = calculate_quartiles(contig_lengths)
-
-    # n50 func requires more than one contig
-    if contig_number > 1:
-        n50 = calculate_n50(contig_lengths, length/2)
-    else:
-        n50 = largest
+    length = int(cumulative_lengths[-1])
+    smallest = int(lengths[0])
+    largest = int(lengths[-1])
+    mean = int(round(length / contig_number, 0))
+    q1, q2, q3 = calculate_quartiles(lengths)
+    n50, l50 = calculate_nx(lengths_descending, cumulative_lengths, length / 2)
+    l90 = calculate_nx(lengths_descending, cumulative_lengths, length * 0.9)[1]
+    ng50 = calculate_nx(lengths_descending, cumulative_lengths, genome_size / 2)[0] if genome_size else None
+    # auN is the length-weighted mean contig length, squares summed as float to avoid overflow
+    aun = int(round(np.dot(lengths, lengths.astype(np.float64)) / length, 0)) if length else None
+
+    # Base composition, GC is relative to unambiguous bases
+    gc = n_count = ambiguous_count = None
+    if residue_counts is not None:
+        gc_count = int(sum(residue_counts[b] for b in GC_BYTES))
+        acgt_count = int(sum(residue_counts[b] for b in ACGT_BYTES))
+        n_count = int(sum(residue_counts[b] for b in N_BYTES))
+        gc = round(gc_count / acgt_count * 100, 2) if acgt_count else None
+        ambiguous_count = length - acgt_count - n_count
 
     # Return ordered stats
-    return contig_number, n50, q1, q2, q3, mean, smallest, largest, length
+    return (contig_number, n50, q1, q2, q3, mean, smallest, largest, length,
+            gc, n_count, ambiguous_count, l50, l90, ng50, aun)
+
+
+def open_stats_cache(cache_fp):
+    connection = sqlite3.connect(cache_fp)
+    # Each calculated entry is committed, which with WAL doesn't need a sync per commit
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.execute('PRAGMA synchronous = NORMAL')
+    # Entries from a cache with different columns can't be reused
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(stats)')]
+    if columns and tuple(columns) != CACHE_KEY_COLUMNS + STATS_COLUMNS + EXTENDED_STATS_COLUMNS:
+        connection.execute('DROP TABLE stats')
+    connection.executescript(CACHE_SCHEMA)
+    return contextlib.closing(connection)
+
+
+def get_file_key(assembly_fp):
+    # Symlinked assemblies are keyed on the file they point to
+    file_stat = assembly_fp.stat()
+    return str(assembly_fp.resolve()), file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino
+
+
+def read_cached_stats(connection, cache_key, extended=False):
+    columns = ', '.join(STATS_COLUMNS + EXTENDED_STATS_COLUMNS)
+    query = 'SELECT %s FROM stats WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ? AND genome_size IS ?' % columns
+    # Residues are only counted for extended stats, so entries without counts can't serve them
+    if extended:
+        query += ' AND n_count IS NOT NULL'
+    return connection.execute(query, cache_key).fetchone()
+
+
+def write_cached_stats(connection, cache_key, stats):
+    query = 'INSERT OR REPLACE INTO stats VALUES (%s)' % ', '.join('?' * (len(cache_key) + len(stats)))
+    with connection:
+        connection.execute(query, (*cache_key, *stats))
+
+
+def prune_stats_cache(connection):
+    stale_paths = list()
+    for path, size, mtime_ns, inode in connection.execute('SELECT path, size, mtime_ns, inode FROM stats'):
+        fp = pathlib.Path(path)
+        if not fp.exists() or get_file_key(fp) != (path, size, mtime_ns, inode):
+            stale_paths.append((path, ))
+    with connection:
+        connection.executemany('DELETE FROM stats WHERE path = ?', stale_paths)
 
 
 def calculate_quartiles(lengths):
-    # Set up
-    np = [0.25, 0.50, 0.75]
-    x = sorted(lengths)
-    n = len(x)
+    # Set up, lengths must be sorted
+    ps = [0.25, 0.50, 0.75]
+    n = len(lengths)
     # Get bounds and quartiles
-    indices = [(n - 1) * p for p in np]
+    indices = [(n - 1) * p for p in ps]
     lo = [math.floor(i) for i in indices]
     hi = [math.ceil(i) for i in indices]
-    qs = [x[i] for i in lo]
+    qs = [int(lengths[i]) for i in lo]
     # Update if required and then return
     for i in range(len(indices)):
         if not indices[i] > lo[i]:
             continue
         h = indices[i] - lo[i]
-        qs[i] = (1 - h) * qs[i] + h * x[hi[i]]
+        qs[i] = (1 - h) * qs[i] + h * int(lengths[hi[i]])
     return qs
 
 
-def calculate_n50(lengths, median):
-    csum = 0
-    for length in sorted(lengths, reverse=True):
-        # If sum exceeds median, return previous length
-        if csum > median:
-            return prev_length
-        # Cumulative sum
-        csum += length
-        prev_length = length
+def calculate_nx(lengths_descending, cumulative_lengths, threshold):
+    # Length and count of contigs, largest first, at which the cumulative length exceeds the threshold
+    index = int(np.searchsorted(cumulative_lengths, threshold, side='right'))
+    if index == len(lengths_descending):
+        return None, None
+    return int(lengths_descending[index]), index + 1
+
+
+def scan_contigs(fh, count_residues=False):
+    # Residues are counted in place within each block, so no sequence is ever built. Line endings and
+    # spaces are not residues, matching SimpleFastaParser, and text before the first record is skipped
+    lengths = list()
+    length = None
+    in_description = False
+    at_line_start = True
+    residue_counts = np.zeros(256, dtype=np.int64) if count_residues else None
+    for block in iter(functools.partial(fh.read, READ_BLOCK_SIZE), b''):
+        block_length = len(block)
+        has_carriage_returns = b'\r' in block
+        # Bytes are counted for the whole block, then for description lines which are removed
+        if count_residues:
+            residue_counts += np.bincount(np.frombuffer(block, dtype=np.uint8), minlength=256)
+        excluded = list()
+        position = 0
+        while position < block_length:
+            # Start a new record, skipping its description line which may span blocks
+            if in_description or (at_line_start and block[position] == 62):
+                if not in_description:
+                    if length is not None:
+                        lengths.append(length)
+                    length = 0
+                description_end = block.find(b'\n', position)
+                in_description = description_end == -1
+                description_stop = block_length if in_description else description_end + 1
+                if count_residues:
+                    excluded.append(block[position:description_stop])
+                if in_description:
+                    break
+                at_line_start = True
+                position = description_stop
+                continue
+
+            # Sequence runs until a line starting with '>'
+            record_start = block.find(b'\n>', position)
+            end = block_length if record_start == -1 else record_start + 1
+            if length is not None:
+                length += end - position - block.count(b'\n', position, end) - block.count(b' ', position, end)
+                if has_carriage_returns:
+                    length -= block.count(b'\r', position, end)
+            elif count_residues:
+                excluded.append(block[position:end])
+            at_line_start = block[end-1] == 10
+            position = end
+        if count_residues and excluded:
+            residue_counts -= np.bincount(np.frombuffer(b''.join(excluded), dtype=np.uint8), minlength=256)
+    if length is not None:
+        lengths.append(length)
+    return lengths, residue_counts
 
 
 if __name__ == '__main__':